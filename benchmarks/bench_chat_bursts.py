@@ -0,0 +1,112 @@
+"""Together calls and answer latency when users send bursts of messages.
+
+Each simulated chat sends --burst messages --gap seconds apart while the
+stub model takes about --llm seconds per answer.  Four policies are compared:
+
+  concurrent   every message runs its own pipeline at once (the old behaviour)
+  serialized   one pipeline per chat at a time; messages queued behind it
+               are answered together
+  supersede    serialized, and a new message cancels the chat's unanswered
+               pipeline
+  debounce     supersede, plus waiting --debounce seconds for follow-ups
+
+"started" counts completion requests that reached the model, "completed"
+the answers the bot sent.  "kept" is the share of sent messages that made it
+into the user's history and "ordered" the share of chats whose history holds
+them in the order they were sent.
+
+    python benchmarks/bench_chat_bursts.py --chats 20 --burst 3 --gap 0.3
+"""
+import argparse
+import asyncio
+import time
+
+from stubs import FakeUpdate, import_app, start_stub_server, stub_env
+
+POLICIES = {
+    "serialized": dict(debounce=0.0, cancel_superseded=False),
+    "supersede": dict(debounce=0.0, cancel_superseded=True),
+    "debounce": None,  # Filled from --debounce
+}
+
+
+def history_positions(history, sent):
+    """Indexes into `sent` of the messages found in the user turns of `history`"""
+    positions = []
+    for entry in history:
+        if entry["role"] == "user":
+            positions += [sent.index(line) for line in entry["content"].split("\n\n") if line in sent]
+    return positions
+
+
+async def run(app, server, policy, args, first_user):
+    if policy != "concurrent":
+        app.chat_scheduler = app.ChatScheduler(max_batch=args.burst, **POLICIES[policy])
+    user_ids = range(first_user, first_user + args.chats)
+    for user_id in user_ids:
+        await app.state_store.get(user_id)
+
+    hits_before = server.hits
+    calls_before = app.llm_calls_total.value
+    last_sent = {}
+    answered = {}
+    tasks = []
+
+    async def chat(user_id):
+        for index in range(args.burst):
+            update = FakeUpdate(user_id, f"message {index} from {user_id}")
+            if policy == "concurrent":
+                batch = app.ChatBatch([(update, time.monotonic())])
+                tasks.append(asyncio.create_task(app.answer_batch(batch)))
+            else:
+                await app.handle_message(update, None)
+            last_sent[user_id] = time.monotonic()
+            if index < args.burst - 1:
+                await asyncio.sleep(args.gap)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(user_id) for user_id in user_ids))
+    await asyncio.gather(*tasks)
+    await app.chat_scheduler.drain()
+    elapsed = time.perf_counter() - started
+
+    kept = ordered = 0
+    for user_id in user_ids:
+        state = await app.state_store.get(user_id)
+        sent = [f"message {index} from {user_id}" for index in range(args.burst)]
+        positions = history_positions(state["history"], sent)
+        kept += len(set(positions))
+        ordered += positions == sorted(positions)
+    return (server.hits - hits_before, app.llm_calls_total.value - calls_before,
+            kept / (args.chats * args.burst), ordered / args.chats, elapsed)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--burst", type=int, default=3, help="messages per chat")
+    parser.add_argument("--gap", type=float, default=0.3, help="seconds between a chat's messages")
+    parser.add_argument("--llm", type=float, default=1.0, help="stub completion time (s)")
+    parser.add_argument("--debounce", type=float, default=0.5)
+    args = parser.parse_args()
+    POLICIES["debounce"] = dict(debounce=args.debounce, cancel_superseded=True)
+
+    tokens = 50
+    server, base_url = start_stub_server(latency=0.0, stream_tokens=tokens, token_delay=args.llm / tokens)
+    env = stub_env(base_url)
+    env["STREAM_RESPONSES"] = "0"
+    app = import_app(env)
+
+    print(f"{args.chats} chats x {args.burst} messages, {args.gap}s apart, {args.llm}s per completion")
+    print(f"{'policy':<11} {'started':>8} {'completed':>10} {'kept':>6} {'ordered':>8} {'total (s)':>10}")
+    try:
+        for index, policy in enumerate(("concurrent", "serialized", "supersede", "debounce")):
+            started, completed, kept, ordered, elapsed = await run(app, server, policy, args, index * args.chats)
+            print(f"{policy:<11} {started:>8} {completed:>10} {kept:>6.0%} {ordered:>8.0%} {elapsed:>10.2f}")
+    finally:
+        await app.shutdown()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+"""Fire N concurrent fake updates through handle_message against local stubs.
+
+With a blocking HTTP layer total latency grows with N; with the shared async
+client it should stay close to a single request's latency until the stub
+server or the connection pool saturates.
+
+    python benchmarks/bench_concurrency.py --latency 0.2 --counts 1 10 50 100
+"""
+import argparse
+import asyncio
+import time
+
+from stubs import FakeUpdate, import_app, start_stub_server, stub_env
+
+
+async def run_batch(app, base_url, count, web):
+    updates = [FakeUpdate(user_id, f"summarize {base_url}/page/{user_id}")
+               for user_id in range(count)]
+    for update in updates:
+        state = await app.state_store.get(update.effective_user.id)
+        state["net"] = web
+
+    started = time.perf_counter()
+    await asyncio.gather(*(app.handle_message(update, None) for update in updates))
+    await app.chat_scheduler.drain()
+    elapsed = time.perf_counter() - started
+
+    failed = sum(1 for update in updates if not update.message.replies
+                 or update.message.replies[-1].startswith("⚠️"))
+    return elapsed, failed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub latency per request (s)")
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--no-web", action="store_true", help="only exercise the LLM call")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency=args.latency)
+    app = import_app(stub_env(base_url))
+
+    print(f"stub latency {args.latency:.3f}s, web mode {'off' if args.no_web else 'on'}")
+    print(f"{'N':>6} {'total (s)':>10} {'per update (s)':>15} {'failed':>7}")
+    try:
+        for count in args.counts:
+            elapsed, failed = await run_batch(app, base_url, count, not args.no_web)
+            print(f"{count:>6} {elapsed:>10.3f} {elapsed / count:>15.4f} {failed:>7}")
+    finally:
+        await app.close_http_session()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""Web context tokens and end-to-end latency with and without the context budget.
+
+Each question links two of the saved fixture pages, so the model request
+carries two page bodies plus search results.  For every WEB_CONTEXT_TOKENS
+value the questions go through app.generate_ai_response against the stub
+upstreams, whose completion time grows with the prompt
+(--prefill seconds per prompt token).  Pages and searches are warmed into
+the caches first, so only the prompt size differs between budgets.  "kept"
+is the share of questions whose answer sentence made it into the context.
+
+    python benchmarks/bench_context_budget.py --budgets 0 2000 1200 800 --prefill 0.0005
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import stubs
+from stubs import import_app, start_stub_server, stub_env
+
+# (question, linked fixture pages, phrase the answer depends on)
+QUESTIONS = [
+    ("how much will the market street bike lane cost and when does construction start",
+     ["long_article.html", "news_article.html"], "$4.2 million"),
+    ("which cpu governor setting lowered the home server idle power",
+     ["long_article.html", "wordpress_post.html"], "powersave"),
+    ("what is the default initial delay for retry backoff",
+     ["docs_page.html", "long_article.html"], "Initial delay in seconds"),
+    ("what was wrong with the choke when the coupe stalled",
+     ["long_article.html", "forum_thread.html"], "bimetal spring"),
+    ("what happened to the legacy v1 API in version 5.0",
+     ["news_article.html", "content_wrapper.html"], "legacy v1 API"),
+    ("сколько пассажиров воспользовались новой станцией метро в первый день",
+     ["itemprop_article.html", "russian_news.html"], "сорока тысяч"),
+]
+# Search descriptions as long as real ones, so results cost what they do in production
+FILLER = ("Independent coverage of city budgets, transit planning, hardware reviews and release notes, "
+          "with background reporting, reader questions and weekly round-ups from our editors. ")
+
+
+async def ask(app, base_url, question, pages, user_id):
+    urls = " ".join(f"{base_url}/fixtures/{name}" for name in pages)
+    started = time.perf_counter()
+    await app.generate_ai_response(f"{question} {urls}", user_id)
+    return time.perf_counter() - started
+
+
+async def run_budget(app, base_url, budget, user_id, contexts):
+    app.WEB_CONTEXT_TOKENS = budget
+    offered = app.web_context_tokens.labels(kind="offered")
+    sent = app.web_context_tokens.labels(kind="sent")
+    offered_before, sent_before = offered.value, sent.value
+    body_sum, body_count = app.llm_request_bytes.sum, app.llm_request_bytes.count
+    timings = []
+    kept = 0
+    for question, pages, phrase in QUESTIONS:
+        contexts.clear()
+        # A fresh user each time keeps history out of the prompt
+        user_id += 1
+        (await app.state_store.get(user_id))["net"] = True
+        timings.append(await ask(app, base_url, question, pages, user_id))
+        kept += phrase in contexts[-1]
+    count = len(QUESTIONS)
+    return user_id, {
+        "offered": (offered.value - offered_before) / count,
+        "sent": (sent.value - sent_before) / count,
+        "body": (app.llm_request_bytes.sum - body_sum) / (app.llm_request_bytes.count - body_count),
+        "mean": statistics.mean(timings),
+        "kept": kept / count,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budgets", type=int, nargs="+", default=[0, 2000, 1200, 800])
+    parser.add_argument("--prefill", type=float, default=0.0005, help="stub seconds per prompt token")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub latency per request (s)")
+    args = parser.parse_args()
+
+    for i, result in enumerate(stubs.SEARX_BODY["results"]):
+        result["content"] = f"{i}. {FILLER}"
+    stubs.DDG_HTML_BODY = stubs.DDG_HTML_BODY.replace("from the DuckDuckGo HTML page.", FILLER)
+    server, base_url = start_stub_server(latency=args.latency, stream_tokens=20, token_delay=0.005,
+                                         prefill_per_token=args.prefill)
+    app = import_app(stub_env(base_url))
+
+    # Record the context each question produced
+    contexts = []
+    gather = app.gather_web_context
+
+    async def recording_gather(*call_args):
+        contexts.append(await gather(*call_args))
+        return contexts[-1]
+    app.gather_web_context = recording_gather
+
+    user_id = 1000
+    try:
+        user_id, _ = await run_budget(app, base_url, 0, user_id, contexts)  # Warm the page and search caches
+        print(f"{len(QUESTIONS)} questions, stub prefill {args.prefill * 1000:.2f} ms/token")
+        print(f"{'budget':>7} {'offered tok':>12} {'sent tok':>9} {'saved':>6} {'body KB':>8} "
+              f"{'mean s':>7} {'vs first':>9} {'answer kept':>12}")
+        baseline = None
+        for budget in args.budgets:
+            user_id, result = await run_budget(app, base_url, budget, user_id, contexts)
+            baseline = baseline or result
+            saved = 1 - result["sent"] / result["offered"]
+            print(f"{budget or 'none':>7} {result['offered']:>12.0f} {result['sent']:>9.0f} {saved:>6.0%} "
+                  f"{result['body'] / 1024:>8.1f} {result['mean']:>7.3f} "
+                  f"{result['mean'] / baseline['mean'] - 1:>+9.1%} {result['kept']:>12.0%}")
+    finally:
+        await app.shutdown()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
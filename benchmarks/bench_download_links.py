@@ -0,0 +1,103 @@
+"""Compare download link detection on link-heavy pages: endswith scan vs. suffix set.
+
+"scan" is the previous find_download_links: every <a> is checked with
+any(href.endswith(ext)) over the 29 extensions, hrefs are lowercased, only
+"/..." and "http..." links are kept and the list is cut to 5 after the whole
+page was scanned.  "suffix" is app.find_download_links: one set lookup on the
+path's extension, relative/query/fragment links resolved, stopping at
+DOWNLOAD_CANDIDATES.  Both run on the same parsed lxml tree; "found" counts
+how many of the page's real download links each one can see.
+
+    python benchmarks/bench_download_links.py --links 1000 10000 --ratio 0.02
+"""
+import argparse
+import random
+import time
+from urllib.parse import urljoin
+
+import lxml.html
+
+from stubs import import_app
+
+EXTENSIONS = ['.exe', '.zip', '.rar', '.tar', '.gz', '.pdf',
+              '.dmg', '.deb', '.rpm', '.msi', '.iso', '.apk',
+              '.jpg', '.jpeg', '.png', '.gif', '.mp3', '.wav',
+              '.mp4', '.avi', '.mov', '.doc', '.docx', '.xls',
+              '.xlsx', '.ppt', '.pptx', '.csv', '.txt']
+
+
+def scan_links(root, base_url):
+    """The endswith-over-a-list detection used before the suffix set"""
+    download_links = []
+    for a in root.iter('a'):
+        href = (a.get('href') or '').lower()
+        if any(href.endswith(ext) for ext in EXTENSIONS):
+            if href.startswith('/'):
+                full_url = urljoin(base_url, href)
+            elif href.startswith('http'):
+                full_url = href
+            else:
+                continue
+            download_links.append({"text": a.text_content().strip() or "Download", "url": full_url})
+    return download_links[:5]
+
+
+def link_page(count, ratio, rng):
+    """A navigation-heavy page; `ratio` of its links are downloads in mixed href forms"""
+    forms = ["/files/{0}", "files/{0}", "https://cdn.example.com/{0}", "/get/{0}?mirror=eu",
+             "{0}#sha256", "../archive/{0}"]
+    names = ["setup-{0}.exe", "report-{0}.pdf", "dataset-{0}.csv", "release-{0}.tar.gz", "slides-{0}.pptx"]
+    anchors = []
+    downloads = 0
+    for i in range(count):
+        if rng.random() < ratio:
+            name = rng.choice(names).format(i)
+            href = rng.choice(forms).format(name)
+            anchors.append(f"<li><a href='{href}'>Download {name.split('-')[0]} {i}</a></li>")
+            downloads += 1
+        else:
+            anchors.append(f"<li><a href='/section/{i}/article-{i}'>Article number {i} in this section</a></li>")
+    html = ("<html><head><title>Links</title></head><body><nav><ul>" + "".join(anchors[:50]) +
+            "</ul></nav><main><ul>" + "".join(anchors[50:]) + "</ul></main></body></html>")
+    return html, downloads
+
+
+def best_of(func, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        started = time.process_time()
+        result = func(*args)
+        times.append(time.process_time() - started)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--links", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--ratio", type=float, default=0.02, help="share of links that are downloads")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    app = import_app({})
+    rng = random.Random(args.seed)
+    url = "https://example.com/docs/page"
+    print(f"DOWNLOAD_CANDIDATES = {app.DOWNLOAD_CANDIDATES}, DOWNLOAD_LINKS = {app.DOWNLOAD_LINKS}")
+    print(f"{'links':>7} {'downloads':>9} {'scan ms':>8} {'suffix ms':>10} {'rank ms':>8} "
+          f"{'scan found':>10} {'suffix found':>12}")
+    for count in args.links:
+        html, downloads = link_page(count, args.ratio, rng)
+        root = lxml.html.document_fromstring(html)
+        scan_time, _ = best_of(scan_links, root, url)
+        suffix_time, links = best_of(app.find_download_links, root, url)
+        rank_time, _ = best_of(app.rank_download_links, links, "download the csv dataset")
+        # Visibility over the whole page, without either extractor's cut-off
+        scan_found = len([a for a in root.iter('a')
+                          if any((a.get('href') or '').lower().endswith(ext) for ext in EXTENSIONS)
+                          and a.get('href').startswith(('/', 'http'))])
+        suffix_found = len(app.find_download_links(root, url, limit=count))
+        print(f"{count:>7} {downloads:>9} {scan_time * 1000:>8.2f} {suffix_time * 1000:>10.3f} "
+              f"{rank_time * 1000:>8.3f} {scan_found:>10} {suffix_found:>12}")
+
+
+if __name__ == "__main__":
+    main()
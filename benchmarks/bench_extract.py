@@ -0,0 +1,121 @@
+"""Compare CPU time of page text extraction: BeautifulSoup cascade vs. lxml block walk.
+
+"cascade" is the previous app.extract_page: a BeautifulSoup tree, decompose of
+script/style/nav elements, up to seven CSS selectors with get_text, then a
+regex pass and truncation.  "blocks" is the current app.extract_page, which
+walks the lxml tree once and stops at PAGE_TEXT_CHARS.
+
+    python benchmarks/bench_extract.py                  # fixtures and synthetic pages
+    python benchmarks/bench_extract.py --corpus saved/  # directory of *.html
+"""
+import argparse
+import os
+import re
+import time
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+
+from bench_page_parse import synthetic_page
+from stubs import import_app
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pages")
+EXTENSIONS = ('.exe', '.zip', '.rar', '.tar', '.gz', '.pdf',
+              '.dmg', '.deb', '.rpm', '.msi', '.iso', '.apk',
+              '.jpg', '.jpeg', '.png', '.gif', '.mp3', '.wav',
+              '.mp4', '.avi', '.mov', '.doc', '.docx', '.xls',
+              '.xlsx', '.ppt', '.pptx', '.csv', '.txt')
+
+
+def cascade_extract(html, url):
+    """The BeautifulSoup selector cascade extract_page used before the block walk"""
+    soup = BeautifulSoup(html, 'lxml')
+    title = str(soup.title.string) if soup.title and soup.title.string else "No Title"
+
+    download_links = []
+    for a in soup.find_all('a', href=True):
+        href = a['href'].lower()
+        if href.endswith(EXTENSIONS):
+            if href.startswith('/'):
+                full_url = urljoin(url, href)
+            elif href.startswith('http'):
+                full_url = href
+            else:
+                continue
+            download_links.append({"text": a.get_text().strip() or "Download", "url": full_url})
+    download_links = download_links[:5]
+
+    for element in soup(["script", "style", "header", "footer", "nav", "aside"]):
+        element.decompose()
+
+    main_content = ""
+    for selector in ['article', 'main', 'div[itemprop="articleBody"]', 'div.content',
+                     'div.post-content', 'div.entry-content', 'body']:
+        element = soup.select_one(selector)
+        if element:
+            main_content = element.get_text(separator='\n', strip=True)
+            if len(main_content) > 100:
+                break
+    if not main_content and soup.body:
+        main_content = soup.body.get_text(separator='\n', strip=True)
+
+    dl_info = ""
+    if download_links:
+        dl_info = "## 🔽 Download Links:\n"
+        for dl in download_links:
+            dl_info += f"- [{dl['text']}]({dl['url']})\n"
+        dl_info += "\n"
+
+    if main_content:
+        main_content = re.sub(r'\s+', ' ', main_content)
+        if len(main_content) > 3000:
+            main_content = main_content[:3000] + "... [truncated]"
+
+    return {"title": title, "content": main_content or "No content extracted", "downloads": dl_info}
+
+
+def load_pages(path):
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(path, name), "rb") as f:
+                pages.append((name, f.read().decode("utf-8", "replace")))
+    return pages
+
+
+def cpu_time(func, html, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        func(html, "https://example.com/page")
+    return (time.process_time() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", help="directory of saved .html pages (default: fixtures)")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per page for small pages")
+    args = parser.parse_args()
+
+    app = import_app({})
+    pages = load_pages(args.corpus or FIXTURES)
+    if not args.corpus:
+        pages += [(f"synthetic-{size // 1024}KB", synthetic_page(size).decode("utf-8"))
+                  for size in (256 * 1024, 2 * 1024 * 1024)]
+
+    print(f"PAGE_TEXT_CHARS = {app.PAGE_TEXT_CHARS}")
+    print(f"{'page':<28} {'size':>8} {'cascade ms':>11} {'blocks ms':>10} {'speedup':>8}")
+    totals = [0.0, 0.0]
+    for name, html in pages:
+        repeat = max(1, args.repeat * 16384 // max(len(html), 16384))
+        before = cpu_time(cascade_extract, html, repeat)
+        after = cpu_time(app.extract_page, html, repeat)
+        totals[0] += before
+        totals[1] += after
+        print(f"{name:<28} {len(html) / 1024:>7.0f}K {before * 1000:>11.2f} {after * 1000:>10.2f} "
+              f"{before / after:>7.1f}x")
+    print(f"{'total':<28} {'':>8} {totals[0] * 1000:>11.2f} {totals[1] * 1000:>10.2f} "
+          f"{totals[0] / totals[1]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Micro-benchmark: per-message regex work before and after the single-pass scanner.
+
+"before" repeats what generate_ai_response and handle_message used to do
+for every message: three inline re.search calls, a re.findall for URLs and
+another https?:// search.  "after" is one app.scan_message call.
+
+    python benchmarks/bench_intent_scan.py --repeat 20000
+"""
+import argparse
+import re
+import timeit
+
+from stubs import import_app
+
+CORPUS = [
+    "hi",
+    "what's the weather like in Berlin today?",
+    "can you download the latest setup.exe for me",
+    "find telegram channels about python programming",
+    "summarize https://example.com/articles/2024/05/some-long-article-title?utm_source=x",
+    "compare https://a.example.org/page and https://b.example.net/other#section please",
+    "Привет! Найди мне канал в telegram про новости",
+    "这个文件在哪里下载 https://example.cn/file.zip",
+    "explain the difference between TCP and UDP in detail with examples " * 4,
+    "get me the pdf of the paper from t.me/science_channel/1234",
+]
+
+
+def legacy_scan(prompt):
+    re.search(r'\b(telegram|t\.me|channel|group)\b', prompt, re.IGNORECASE)
+    re.search(r'\b(download|file|install|setup|get)\b|\.(exe|zip|rar|pdf|dmg|deb|apk)\b', prompt, re.IGNORECASE)
+    re.search(r'https?://[^\s]+', prompt)
+    urls = re.findall(r'https?://[^\s<>"]+', prompt)
+    re.search(r'https?://', prompt)
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=20000)
+    args = parser.parse_args()
+
+    app = import_app({})
+    for message in CORPUS:
+        assert list(app.scan_message(message).urls) == legacy_scan(message), message
+
+    before = timeit.timeit(lambda: [legacy_scan(m) for m in CORPUS], number=args.repeat)
+    after = timeit.timeit(lambda: [app.scan_message(m) for m in CORPUS], number=args.repeat)
+    count = args.repeat * len(CORPUS)
+    print(f"messages scanned: {count}")
+    print(f"before: {before / count * 1e6:.2f} µs/message")
+    print(f"after:  {after / count * 1e6:.2f} µs/message ({before / after:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Together calls and answer latency with and without the LLM response cache.
+
+New users arrive at --rate per second, each asking one of --prompts canned
+first-turn questions picked with Zipf weights (a few questions are asked
+far more often than the rest).  Together is limited to --together-rate
+calls per second as in production, and the stub completion takes
+--latency seconds.  With --web the users have web search on, so answers
+are built on the stub search results and cached for LLM_CACHE_WEB_TTL.
+
+    python benchmarks/bench_llm_cache.py --requests 120 --rate 3 --prompts 20
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from stubs import import_app, start_stub_server, stub_env
+
+
+async def run(app, server, args, cache, first_user):
+    app.LLM_CACHE = cache
+    app.response_cache = app.SearchCache(app.LLM_CACHE_BYTES)
+    rate = args.together_rate
+    app.rate_limits["together"] = app.UpstreamScheduler("together", rate, app.LocalBucket(max(1.0, rate)))
+    rng = random.Random(11)
+    prompts = [f"what can you help me with, question {index}?" for index in range(args.prompts)]
+    weights = [1 / (rank + 1) for rank in range(args.prompts)]
+
+    calls_before = app.llm_calls_total.value
+    timings = []
+
+    async def ask(user_id, prompt):
+        (await app.state_store.get(user_id))["net"] = args.web
+        started = time.perf_counter()
+        await app.generate_ai_response(prompt, user_id)
+        timings.append(time.perf_counter() - started)
+
+    tasks = []
+    started = time.perf_counter()
+    for index in range(args.requests):
+        prompt = rng.choices(prompts, weights)[0]
+        tasks.append(asyncio.create_task(ask(first_user + index, prompt)))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+    total = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        "calls": app.llm_calls_total.value - calls_before,
+        "hits": app.response_cache.hits,
+        "lookups": app.response_cache.hits + app.response_cache.misses,
+        "mean": statistics.mean(timings),
+        "p95": timings[int(len(timings) * 0.95) - 1],
+        "total": total,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=120)
+    parser.add_argument("--rate", type=float, default=3, help="new users per second")
+    parser.add_argument("--prompts", type=int, default=20, help="distinct canned questions")
+    parser.add_argument("--together-rate", type=float, default=1, help="Together calls per second")
+    parser.add_argument("--latency", type=float, default=0.8, help="stub completion latency (s)")
+    parser.add_argument("--web", action="store_true", help="users have web search on")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency=args.latency)
+    app = import_app(stub_env(base_url))
+    print(f"{args.requests} first-turn questions at {args.rate}/s over {args.prompts} prompts, "
+          f"Together {args.together_rate}/s, web {'on' if args.web else 'off'}")
+    print(f"{'cache':<6} {'together calls':>14} {'hit rate':>9} {'mean s':>7} {'p95 s':>7} {'total s':>8}")
+    try:
+        user_id = 1000
+        for cache in (False, True):
+            result = await run(app, server, args, cache, user_id)
+            user_id += args.requests
+            hit_rate = result["hits"] / result["lookups"] if result["lookups"] else 0.0
+            print(f"{'on' if cache else 'off':<6} {result['calls']:>14} {hit_rate:>9.0%} "
+                  f"{result['mean']:>7.3f} {result['p95']:>7.3f} {result['total']:>8.2f}")
+    finally:
+        await app.shutdown()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,211 @@
+"""Reply delivery under Telegram's flood limits, direct sends vs the outbox.
+
+Every simulated chat streams a long answer (emoji included) into a reply the
+way handle_message does: an edit every --edit-interval seconds while tokens
+arrive, then a final render.  A fake Bot API enforces roughly Telegram's
+limits -- a per-chat bucket of --chat-rate sends/sec with a burst of
+--chat-burst and a bot-wide --global-rate -- and answers excess calls with
+RetryAfter.  It also rejects messages over 4096 UTF-16 code units.
+
+  direct   the old StreamingReply: back-to-back sends of 4096-character
+           slices, one typing action, no flood-control handling
+  outbox   StreamingReply through app.outbox with typing keepalive
+
+"delivered" is the share of chats whose final visible text matches the
+answer, "lost" counts answers that failed part-way.
+
+    python benchmarks/bench_outbound.py --chats 20 --answer-chars 9000
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+from stubs import import_app
+
+
+class FakeBotAPI:
+    """Token buckets standing in for Telegram's flood control"""
+
+    def __init__(self, chat_rate, chat_burst, global_rate, penalty):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_rate = global_rate
+        self.penalty = penalty
+        self.buckets = {}
+        self.calls = 0
+        self.retry_after = 0
+        self.too_long = 0
+
+    def _take(self, key, rate, burst):
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens - self.penalty * rate, now)  # Flooding extends the wait
+            self.retry_after += 1
+            raise RetryAfter(max(1, math.ceil((1 - tokens) / rate + self.penalty)))
+        self.buckets[key] = (tokens - 1, now)
+
+    def call(self, chat_id, text=None):
+        self.calls += 1
+        if text is not None and len(text.encode("utf-16-le")) // 2 > 4096:
+            self.too_long += 1
+            raise BadRequest("Message is too long")
+        self._take(None, self.global_rate, self.global_rate)
+        self._take(chat_id, self.chat_rate, self.chat_burst)
+
+
+class Sent:
+    def __init__(self, api, chat_id, text):
+        self.api = api
+        self.chat_id = chat_id
+        self.text = text
+
+    async def edit_text(self, text, **kwargs):
+        self.api.call(self.chat_id, text)
+        self.text = text
+        return self
+
+
+class ChatMessage:
+    def __init__(self, api, chat_id):
+        self.api = api
+        self.chat_id = chat_id
+        self.sent = []
+
+    async def reply_text(self, text, **kwargs):
+        self.api.call(self.chat_id, text)
+        self.sent.append(Sent(self.api, self.chat_id, text))
+        return self.sent[-1]
+
+    async def reply_chat_action(self, action, **kwargs):
+        self.api.call(self.chat_id)
+        return True
+
+
+class DirectReply:
+    """The StreamingReply this repo used before the outbox"""
+
+    max_length = 4096
+
+    def __init__(self, message, interval):
+        self.message = message
+        self.interval = interval
+        self.last_render = 0.0
+        self.parts = []
+
+    async def update(self, text):
+        if time.monotonic() - self.last_render >= self.interval:
+            await self._render(text)
+
+    async def finish(self, text):
+        await self._render(text)
+
+    async def _render(self, text):
+        self.last_render = time.monotonic()
+        chunks = [text[i:i + self.max_length] for i in range(0, len(text), self.max_length)]
+        for index, chunk in enumerate(chunks):
+            if index < len(self.parts):
+                sent, previous = self.parts[index]
+                if chunk != previous:
+                    try:
+                        await sent.edit_text(chunk)
+                        self.parts[index] = (sent, chunk)
+                    except Exception:
+                        pass
+            else:
+                sent = await self.message.reply_text(chunk)
+                self.parts.append((sent, chunk))
+
+
+def make_answer(rng, chars):
+    words = ["token", "bucket", "flood", "limit", "чат", "ответ", "👍", "🧑‍💻", "🇺🇦", "éte"]
+    out = []
+    while sum(map(len, out)) < chars:
+        out.append(rng.choice(words))
+        if rng.random() < 0.05:
+            out.append("\n\n")
+    return " ".join(out)
+
+
+async def stream_chat(app, mode, message, answer, args):
+    steps = args.steps
+    if mode == "direct":
+        reply = DirectReply(message, args.edit_interval)
+        await message.reply_chat_action("typing")
+        for step in range(1, steps + 1):
+            await asyncio.sleep(args.generation / steps)
+            await reply.update(answer[:len(answer) * step // steps])
+        await reply.finish(answer)
+        return
+
+    reply = app.StreamingReply(message, args.edit_interval)
+    async with app.outbox.typing(message):
+        for step in range(1, steps + 1):
+            await asyncio.sleep(args.generation / steps)
+            await reply.update(answer[:len(answer) * step // steps])
+        await reply.finish(answer)
+
+
+async def run(app, mode, args):
+    api = FakeBotAPI(args.chat_rate, args.chat_burst, args.global_rate, args.penalty)
+    app.outbox = app.TelegramOutbox(app.UpstreamScheduler(
+        f"bench_{mode}", app.TELEGRAM_SEND_RATE, app.LocalBucket(app.TELEGRAM_SEND_RATE)))
+    rng = random.Random(7)
+    answers = [make_answer(rng, args.answer_chars) for _ in range(args.chats)]
+    messages = [ChatMessage(api, chat_id) for chat_id in range(args.chats)]
+    finished = []
+    lost = 0
+
+    async def chat(message, answer):
+        nonlocal lost
+        started = time.monotonic()
+        try:
+            await stream_chat(app, mode, message, answer, args)
+            finished.append(time.monotonic() - started)
+        except Exception:
+            lost += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(chat(message, answer) for message, answer in zip(messages, answers)))
+    total = time.monotonic() - started
+
+    delivered = sum("".join("".join(sent.text.split()) for sent in message.sent) == "".join(answer.split())
+                    for message, answer in zip(messages, answers))
+    finished.sort()
+    p95 = finished[min(len(finished) - 1, int(len(finished) * 0.95))] if finished else float("nan")
+    return dict(delivered=delivered / args.chats, lost=lost, calls=api.calls, retry_after=api.retry_after,
+                too_long=api.too_long, p95=p95, total=total)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--answer-chars", type=int, default=9000)
+    parser.add_argument("--generation", type=float, default=4.0, help="seconds the model streams each answer")
+    parser.add_argument("--steps", type=int, default=40, help="text updates per answer")
+    parser.add_argument("--edit-interval", type=float, default=0.5)
+    parser.add_argument("--chat-rate", type=float, default=1.0)
+    parser.add_argument("--chat-burst", type=float, default=4.0)
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    parser.add_argument("--penalty", type=float, default=2.0, help="extra seconds a flooding chat must wait")
+    args = parser.parse_args()
+
+    app = import_app({})
+    print(f"{'mode':<8} {'delivered':>9} {'lost':>5} {'calls':>6} {'retry_after':>11} {'too long':>8} "
+          f"{'finish p95 (s)':>14} {'total (s)':>9}")
+    for mode in ("direct", "outbox"):
+        result = await run(app, mode, args)
+        print(f"{mode:<8} {result['delivered']:>9.0%} {result['lost']:>5} {result['calls']:>6} "
+              f"{result['retry_after']:>11} {result['too_long']:>8} {result['p95']:>14.2f} {result['total']:>9.2f}")
+    messages = app.outbox.queue_seconds.labels(method="sendMessage")
+    print(f"outbox sendMessage queue p50 {messages.quantile(0.5)}s p99 {messages.quantile(0.99)}s, "
+          f"{app.outbox.retried.value} flood retries, {app.outbox.dropped.value} dropped edits/typing")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+"""Compare peak memory and parse time of page extraction before and after.
+
+"before" mirrors the original fetch_webpage_content: the whole body is kept
+and parsed twice (once for content, once by find_download_links).  "after"
+takes what read_html_capped keeps (at most MAX_PAGE_BYTES) and hands it to
+ParsePool.parse_page, the call fetch_webpage_content makes.  The pool has no
+workers here, so the parse runs in this process and its memory is measured;
+in production the same parse_page call runs in a worker.
+
+    python benchmarks/bench_page_parse.py                 # synthetic large pages
+    python benchmarks/bench_page_parse.py --corpus saved/  # directory of *.html
+"""
+import argparse
+import asyncio
+import os
+import re
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from stubs import import_app
+
+EXTENSIONS = ['.exe', '.zip', '.rar', '.tar', '.gz', '.pdf',
+              '.dmg', '.deb', '.rpm', '.msi', '.iso', '.apk',
+              '.jpg', '.jpeg', '.png', '.gif', '.mp3', '.wav',
+              '.mp4', '.avi', '.mov', '.doc', '.docx', '.xls',
+              '.xlsx', '.ppt', '.pptx', '.csv', '.txt']
+
+
+def synthetic_page(size):
+    """A link-heavy article page of roughly `size` bytes"""
+    block = ("<div class='post'><p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing. " * 8 +
+             "</p><a href='/files/archive.zip'>archive</a><a href='/about'>about</a></div>\n")
+    count = max(1, size // len(block))
+    return ("<html><head><title>Synthetic</title><script>var x = 1;</script></head><body>"
+            "<nav>menu</nav><article>" + block * count + "</article></body></html>").encode("utf-8")
+
+
+def load_corpus(path):
+    if not path:
+        return [(f"synthetic-{size // 1024}KB", synthetic_page(size))
+                for size in (256 * 1024, 2 * 1024 * 1024, 8 * 1024 * 1024)]
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(path, name), "rb") as f:
+                pages.append((name, f.read()))
+    return pages
+
+
+def legacy_extract(content, url):
+    """The original two-parse extraction over the full body"""
+    soup = BeautifulSoup(content, 'lxml')
+    title = soup.title.string if soup.title else "No Title"
+    for element in soup(["script", "style", "header", "footer", "nav", "aside"]):
+        element.decompose()
+    main_content = ""
+    for selector in ['article', 'main', 'div[itemprop="articleBody"]', 'div.content',
+                     'div.post-content', 'div.entry-content', 'body']:
+        element = soup.select_one(selector)
+        if element:
+            main_content = element.get_text(separator='\n', strip=True)
+            if len(main_content) > 100:
+                break
+    links = []
+    for a in BeautifulSoup(content.decode('utf-8', 'replace'), 'lxml').find_all('a', href=True):
+        href = a['href'].lower()
+        if any(href.endswith(ext) for ext in EXTENSIONS) and href.startswith(('/', 'http')):
+            links.append(href)
+    main_content = re.sub(r'\s+', ' ', main_content)[:3000]
+    return title, main_content, links[:5]
+
+
+def capped_extract(app, pool, content, url):
+    """Parse the capped body the way fetch_webpage_content does, through the parse pool"""
+    raw = content[:app.MAX_PAGE_BYTES]
+    charset = app.detect_charset(None, raw[:65536])
+    return asyncio.run(pool.parse_page(raw, charset, url))
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", help="directory of saved .html pages")
+    args = parser.parse_args()
+
+    app = import_app({})
+    pool = app.ParsePool(0, app.PARSE_QUEUE, app.PARSE_CPU_SECONDS, app.PARSE_INLINE_BYTES)
+    print(f"MAX_PAGE_BYTES = {app.MAX_PAGE_BYTES}")
+    print(f"{'page':<28} {'size':>9} {'before s':>9} {'before MB':>10} {'after s':>8} {'after MB':>9}")
+    for name, content in load_corpus(args.corpus):
+        url = "https://example.com/page"
+        before_time, before_peak = measure(legacy_extract, content, url)
+        after_time, after_peak = measure(capped_extract, app, pool, content, url)
+        print(f"{name:<28} {len(content) / 1024:>8.0f}K {before_time:>9.3f} {before_peak:>10.1f} "
+              f"{after_time:>8.3f} {after_peak:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
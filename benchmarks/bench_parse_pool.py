@@ -0,0 +1,123 @@
+"""Chat latency while large pages are parsed, inline vs. in the parse pool.
+
+Light chats (web search off) arrive at --rate per second and go through
+app.generate_ai_response against the stub Together endpoint, which answers
+after --latency seconds.  At the same time --parsers loops push synthetic
+--page-kb pages through app.parse_pool.parse_page back to back, as
+concurrent URL fetches would.  Each mode runs for --seconds:
+
+  idle     no parsing, the baseline chat latency
+  inline   PARSE_WORKERS=0: every page is parsed on the event loop
+  pool     PARSE_WORKERS=--workers: pages go to worker processes
+
+"pages" counts full parses, "fallback" the pages parsed from their first
+PARSE_FALLBACK_BYTES inline because the pool queue was full.
+
+    python benchmarks/bench_parse_pool.py --seconds 8 --parsers 4 --page-kb 2048
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from stubs import import_app, start_stub_server, stub_env
+
+
+def synthetic_page(kb, seed):
+    """A table-heavy page without an article container, so extraction walks all of it"""
+    row = ("<tr><td>Row {i}</td><td>" + "cell text with a few words " * 6 +
+           "</td><td><a href='/item/{i}'>details</a></td></tr>\n")
+    rows = []
+    size = 0
+    i = 0
+    while size < kb * 1024:
+        rows.append(row.format(i=f"{seed}-{i}"))
+        size += len(rows[-1])
+        i += 1
+    return ("<html><head><title>Big table</title></head><body><table>" + "".join(rows) +
+            "</table></body></html>").encode("utf-8")
+
+
+async def run_mode(app, mode, args, first_user):
+    app.parse_pool.shutdown()
+    workers = args.workers if mode == "pool" else 0
+    app.parse_pool = app.ParsePool(workers, app.PARSE_QUEUE, app.PARSE_CPU_SECONDS, app.PARSE_INLINE_BYTES)
+    pages = [synthetic_page(args.page_kb, seed) for seed in range(8)]
+    if workers:
+        # Start the workers before measuring; spawning them costs about a second each
+        await asyncio.gather(*(app.parse_pool.parse_page(pages[0], "utf-8", "https://example.com/warm")
+                               for _ in range(workers)))
+    fallback = app.parse_tasks.labels(where="fallback")
+    fallback_before = fallback.value
+    lag = app.Histogram(app.LAG_BUCKETS)
+    app.loop_monitor.histogram = lag
+
+    stop = time.monotonic() + args.seconds
+    parsed = 0
+
+    async def parser(index):
+        nonlocal parsed
+        while time.monotonic() < stop:
+            page = pages[(index + parsed) % len(pages)]
+            await app.parse_pool.parse_page(page, "utf-8", f"https://example.com/{index}/{parsed}")
+            parsed += 1
+            await asyncio.sleep(0)
+
+    timings = []
+
+    async def chat(user_id):
+        started = time.perf_counter()
+        await app.generate_ai_response("hello, how are you today?", user_id)
+        timings.append(time.perf_counter() - started)
+
+    parsers = [asyncio.create_task(parser(index)) for index in range(args.parsers if mode != "idle" else 0)]
+    chats = []
+    user_id = first_user
+    while time.monotonic() < stop:
+        user_id += 1
+        chats.append(asyncio.create_task(chat(user_id)))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*parsers, *chats)
+
+    timings.sort()
+    return user_id, {
+        "chats": len(timings),
+        "p50": statistics.median(timings),
+        "p95": timings[int(len(timings) * 0.95) - 1],
+        "max": timings[-1],
+        "lag": lag.quantile(0.99),
+        "pages": parsed,
+        "fallback": fallback.value - fallback_before,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=8)
+    parser.add_argument("--rate", type=float, default=10, help="chats per second")
+    parser.add_argument("--latency", type=float, default=0.2, help="stub completion latency (s)")
+    parser.add_argument("--parsers", type=int, default=4, help="concurrent page parse loops")
+    parser.add_argument("--page-kb", type=int, default=2048)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency=args.latency, stream_tokens=10, token_delay=0.001)
+    app = import_app(stub_env(base_url))
+    await app.loop_monitor.start()
+    print(f"{args.rate:g} chats/s for {args.seconds:g}s, {args.parsers} parse loops over {args.page_kb} KB pages")
+    print(f"{'mode':<7} {'chats':>6} {'p50 s':>7} {'p95 s':>7} {'max s':>7} {'lag p99 s':>10} "
+          f"{'pages':>6} {'fallback':>9}")
+    try:
+        user_id = 1000
+        for mode in ("idle", "inline", "pool"):
+            user_id, result = await run_mode(app, mode, args, user_id)
+            print(f"{mode:<7} {result['chats']:>6} {result['p50']:>7.3f} {result['p95']:>7.3f} "
+                  f"{result['max']:>7.3f} {result['lag']:>10} {result['pages']:>6} {result['fallback']:>9}")
+    finally:
+        app.loop_monitor.stop()
+        await app.shutdown()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
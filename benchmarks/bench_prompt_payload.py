@@ -0,0 +1,76 @@
+"""Bytes sent and serialization time per Together.ai request: full rebuild vs. cached prefix.
+
+"rebuild" is how requests were built before: a fresh messages list with the
+system prompt and web instructions, serialized as a whole by aiohttp's
+json= (json.dumps with ASCII escapes).  "prefix" is app.PromptPrefix: the
+static head is encoded once and only context, history and prompt are
+encoded per request.
+
+    python benchmarks/bench_prompt_payload.py --history 20 --repeat 2000
+"""
+import argparse
+import json
+import time
+
+from stubs import import_app
+
+ENGLISH = "The scheduler moved another batch of services and latency stayed flat. "
+RUSSIAN = "Планировщик перенёс ещё одну группу сервисов, задержка не изменилась. "
+
+
+def rebuild_body(app, context, history, prompt, stream):
+    """The per-request serialization used before the prefix cache"""
+    messages = [{"role": "system", "content": app.SYSTEM_PROMPT}]
+    if context:
+        messages.append({"role": "system", "content": context})
+        messages.append({"role": "system", "content": app.WEB_INSTRUCTIONS})
+    messages.extend({"role": msg["role"], "content": msg["content"]} for msg in history)
+    messages.append({"role": "user", "content": prompt})
+    payload = {"model": app.MODEL_NAME, "messages": messages,
+               "max_tokens": app.MAX_COMPLETION_TOKENS, "temperature": 0.5}
+    if stream:
+        payload["stream"] = True
+    return json.dumps(payload).encode("utf-8")
+
+
+def prefix_body(app, context, history, prompt, stream):
+    prefix = app.prompt_prefixes[bool(context)]
+    messages = [{"role": "system", "content": context}] if context else []
+    messages.extend({"role": msg["role"], "content": msg["content"]} for msg in history)
+    messages.append({"role": "user", "content": prompt})
+    return prefix.body(messages, stream)
+
+
+def per_call(func, args, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        body = func(*args)
+    return (time.perf_counter() - started) / repeat, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--history", type=int, default=20, help="history messages per request")
+    parser.add_argument("--context", type=int, default=4000, help="web context characters")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = import_app({})
+    print(f"system prompt {len(app.SYSTEM_PROMPT)} chars, web instructions {len(app.WEB_INSTRUCTIONS)} chars")
+    print(f"{'request':<22} {'rebuild B':>10} {'prefix B':>9} {'rebuild us':>11} {'prefix us':>10} {'static us':>10}")
+    for language, sentence in (("en", ENGLISH), ("ru", RUSSIAN)):
+        history = [{"role": "user" if i % 2 == 0 else "assistant", "content": sentence * 3}
+                   for i in range(args.history)]
+        context = (sentence * (args.context // len(sentence) + 1))[:args.context]
+        for name, ctx in (("chat", ""), ("web", context)):
+            call = (app, ctx, history, sentence, True)
+            before_time, before_bytes = per_call(rebuild_body, call, args.repeat)
+            after_time, after_bytes = per_call(prefix_body, call, args.repeat)
+            # What encoding the static head alone cost on every request before
+            static_time, _ = per_call(rebuild_body, (app, "x" if ctx else "", [], "", True), args.repeat)
+            print(f"{language + ' ' + name:<22} {before_bytes:>10} {after_bytes:>9} {before_time * 1e6:>11.1f} "
+                  f"{after_time * 1e6:>10.1f} {static_time * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Load test the user state store with many synthetic users.
+
+Each user sends one message (state loaded or created, two history entries
+appended, marked dirty), then random users are looked up again.  Reports
+RSS as the user count grows and lookup latency percentiles.
+
+    python benchmarks/bench_state_store.py --users 100000 --cache 10000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import psutil
+
+from stubs import import_app
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--cache", type=int, default=10000, help="STATE_CACHE_USERS")
+    parser.add_argument("--lookups", type=int, default=50000)
+    args = parser.parse_args()
+
+    app = import_app({})
+    process = psutil.Process()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = app.UserStateStore(app.SQLiteStateBackend(os.path.join(tmp, "state.db")),
+                                   max_users=args.cache, idle_seconds=3600, flush_interval=0.2)
+        baseline = process.memory_info().rss / (1024 * 1024)
+        print(f"baseline RSS {baseline:.1f} MB")
+        print(f"{'users':>8} {'RSS MB':>8} {'cached':>8}")
+
+        started = time.perf_counter()
+        step = max(1, args.users // 10)
+        for user_id in range(args.users):
+            state = await store.get(user_id)
+            state["history"] = state["history"] + [
+                {"role": "user", "content": f"question {user_id} " * 20, "tokens": 60},
+                {"role": "assistant", "content": f"answer {user_id} " * 40, "tokens": 120},
+            ]
+            store.mark_dirty(user_id, state)
+            if user_id % 100 == 0:
+                await asyncio.sleep(0)
+            if (user_id + 1) % step == 0:
+                rss = process.memory_info().rss / (1024 * 1024)
+                print(f"{user_id + 1:>8} {rss:>8.1f} {len(store._cache):>8}")
+        await store.flush()
+        print(f"wrote {args.users} users in {time.perf_counter() - started:.2f}s")
+
+        latencies = []
+        for _ in range(args.lookups):
+            user_id = random.randrange(args.users)
+            t0 = time.perf_counter()
+            await store.get(user_id)
+            latencies.append(time.perf_counter() - t0)
+        print(f"lookups: p50 {percentile(latencies, 0.5) * 1000:.3f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.3f} ms, "
+              f"max {max(latencies) * 1000:.3f} ms")
+        print(f"final RSS {process.memory_info().rss / (1024 * 1024):.1f} MB, {store.stats()}")
+        await store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+"""Time to first visible token with and without streamed completions.
+
+The stub completion endpoint answers after --latency seconds and then
+produces --tokens tokens, one every --token-delay seconds.  Without
+streaming the user sees nothing until the whole completion has arrived.
+
+    python benchmarks/bench_streaming.py --tokens 200 --token-delay 0.02
+"""
+import argparse
+import asyncio
+import time
+
+from stubs import FakeUpdate, import_app, start_stub_server, stub_env
+
+
+async def run(app, stream, count):
+    app.STREAM_RESPONSES = stream
+    app.first_token_latency = app.Histogram(app.WAIT_BUCKETS)
+    updates = [FakeUpdate(user_id, "tell me a story") for user_id in range(count)]
+    started = time.perf_counter()
+    await asyncio.gather(*(app.handle_message(update, None) for update in updates))
+    await app.chat_scheduler.drain()
+    total = time.perf_counter() - started
+    return app.first_token_latency, total
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--count", type=int, default=10, help="concurrent chats")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency=args.latency, stream_tokens=args.tokens,
+                                         token_delay=args.token_delay)
+    app = import_app(stub_env(base_url))
+    app.STREAM_EDIT_INTERVAL = 0.5
+
+    print(f"{'mode':<10} {'ttft mean (s)':>14} {'ttft p95 (s)':>13} {'total (s)':>10}")
+    try:
+        for stream in (False, True):
+            histogram, total = await run(app, stream, args.count)
+            mean = histogram.sum / histogram.count if histogram.count else 0.0
+            print(f"{'stream' if stream else 'blocking':<10} {mean:>14.3f} "
+                  f"{histogram.quantile(0.95):>13} {total:>10.3f}")
+    finally:
+        await app.close_http_session()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+"""Web context latency: URLs fetched one by one then searched, vs. all at once.
+
+"sequential" repeats what generate_ai_response used to do: fetch each URL in
+turn and only then run the search.  "concurrent" is app.gather_web_context,
+which starts the fetches and the search together under WEB_DEADLINE.  Every
+round uses fresh URLs and queries so neither cache helps.
+
+    python benchmarks/bench_web_context.py --latency 0.3 --urls 1 2 4 --rounds 5
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from stubs import import_app, start_stub_server, stub_env
+
+
+async def sequential(app, prompt, scan, max_urls):
+    for url in scan.urls[:max_urls]:
+        await app.fetch_webpage_content(url)
+    await app.triple_search(prompt, 1, scan.intents)
+
+
+async def concurrent(app, prompt, scan, max_urls):
+    app.MAX_FETCH_URLS = max_urls
+    await app.gather_web_context(prompt, 1, scan)
+
+
+async def measure(app, base_url, mode, url_count, rounds):
+    timings = []
+    for round_index in range(rounds):
+        tag = f"{mode}-{url_count}-{round_index}"
+        urls = " ".join(f"{base_url}/page/{tag}/{i}" for i in range(url_count))
+        prompt = f"compare these pages {tag} {urls}"
+        scan = app.scan_message(prompt)
+        started = time.perf_counter()
+        await (sequential if mode == "sequential" else concurrent)(app, prompt, scan, url_count)
+        timings.append(time.perf_counter() - started)
+    return statistics.mean(timings)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.3, help="stub latency per request (s)")
+    parser.add_argument("--urls", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency=args.latency)
+    app = import_app(stub_env(base_url))
+
+    print(f"stub latency {args.latency:.2f}s per request")
+    print(f"{'urls':>5} {'sequential (s)':>15} {'concurrent (s)':>15}")
+    try:
+        for url_count in args.urls:
+            before = await measure(app, base_url, "sequential", url_count, args.rounds)
+            after = await measure(app, base_url, "concurrent", url_count, args.rounds)
+            print(f"{url_count:>5} {before:>15.3f} {after:>15.3f}")
+    finally:
+        await app.shutdown()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""Fault-injection harness for the upstream circuit breakers.
+
+Runs rounds of searches and completions against stub upstreams in three
+phases: healthy, faulty (SearX answers 503, telegago hangs past the slow-call
+threshold, Together answers 500) and recovered.  For each phase it reports
+the mean round time, how many requests reached the faulty endpoints and the
+breaker states, then checks that the breakers opened during the faults and
+closed again after recovery.  Exits non-zero if they did not.
+
+    python benchmarks/breaker_harness.py --rounds 12
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from stubs import FaultyStubHandler, import_app, start_stub_server, stub_env
+
+FAULTS = {
+    "/searx": {"error_rate": 1.0, "status": 503},
+    "/telegago": {"delay": 1.5},
+    "/v1/chat/completions": {"error_rate": 1.0, "status": 500},
+}
+
+
+async def run_round(app, index, phase):
+    started = time.monotonic()
+    query = f"{phase} query {index}"  # Unique per round so the search cache stays out of the way
+    await app.triple_search(query, user_id=1, intents={"telegram"})
+    reply = await app.generate_ai_response(query, user_id=1)
+    return time.monotonic() - started, reply
+
+
+async def run_phase(app, server, phase, rounds):
+    hits_before, faulted_before = server.hits, server.faulted
+    timings = []
+    replies = set()
+    for index in range(rounds):
+        elapsed, reply = await run_round(app, index, phase)
+        timings.append(elapsed)
+        replies.add(reply[:60])
+    states = {name: breaker.state for name, breaker in app.circuit_breakers.items()}
+    print(f"{phase:>10}: mean round {sum(timings) / len(timings) * 1000:7.1f} ms, "
+          f"last round {timings[-1] * 1000:7.1f} ms, "
+          f"{server.hits - hits_before:3d} upstream requests ({server.faulted - faulted_before} faulted)")
+    print(f"{'':>10}  breakers: {states}")
+    return states
+
+
+async def main_async(args):
+    server, base_url = start_stub_server(latency=0.01, handler=FaultyStubHandler,
+                                         stream_tokens=5, token_delay=0)
+    env = stub_env(base_url)
+    env.update({
+        "STREAM_RESPONSES": "0",
+        "SEARCH_DEADLINE": "5",
+        "ROUTER_EMPTY_LIMIT": "1000",  # Keep the engine router from masking the breakers
+        "BREAKER_WINDOW": "10",
+        "BREAKER_MIN_CALLS": "4",
+        "BREAKER_SLOW_SECONDS": "1",
+        "BREAKER_OPEN_SECONDS": str(args.open_seconds),
+    })
+    app = import_app(env)
+
+    healthy = await run_phase(app, server, "healthy", args.rounds)
+
+    server.faults = FAULTS
+    faulty = await run_phase(app, server, "faulty", args.rounds)
+
+    server.faults = {}
+    await asyncio.sleep(args.open_seconds)
+    recovered = await run_phase(app, server, "recovered", args.rounds)
+
+    print("\nbreakers:")
+    for name, breaker in app.circuit_breakers.items():
+        print(f"  {name:>10}: {breaker.stats()}")
+    await app.shutdown(None)
+
+    failures = []
+    if any(state != "closed" for state in healthy.values()):
+        failures.append(f"breakers open while healthy: {healthy}")
+    for name in ("searx", "telegram", "together"):
+        if faulty[name] != "open":
+            failures.append(f"{name} breaker did not open under faults")
+        if recovered[name] != "closed":
+            failures.append(f"{name} breaker did not close after recovery")
+    if faulty["duckduckgo"] != "closed":
+        failures.append("duckduckgo breaker opened although its upstream was healthy")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--open-seconds", type=float, default=2.0)
+    sys.exit(asyncio.run(main_async(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
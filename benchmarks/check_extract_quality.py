@@ -0,0 +1,82 @@
+"""Quality regression check for page extraction against the saved fixture corpus.
+
+Every page in fixtures/pages has an entry in expected.json listing its title,
+phrases the extracted content must include (article text), phrases it must
+exclude (navigation, comments, sharing and promo boilerplate) and, optionally,
+download links.  Both app.extract_page and the old BeautifulSoup cascade are
+scored; the script exits non-zero if app.extract_page misses any expectation.
+
+    python benchmarks/check_extract_quality.py
+    python benchmarks/check_extract_quality.py --verbose   # print each failure
+"""
+import argparse
+import json
+import os
+import sys
+
+from bench_extract import FIXTURES, cascade_extract, load_pages
+from stubs import import_app
+
+
+def check(result, expected):
+    """Return the list of expectations `result` fails"""
+    failures = []
+    if result["title"] != expected["title"]:
+        failures.append(f"title {result['title']!r}")
+    for phrase in expected.get("include", []):
+        if phrase not in result["content"]:
+            failures.append(f"missing {phrase!r}")
+    for phrase in expected.get("exclude", []):
+        if phrase in result["content"]:
+            failures.append(f"boilerplate {phrase!r}")
+    downloads = result["downloads"]  # Formatted markdown from the cascade, a list of links from app
+    if isinstance(downloads, list):
+        downloads = [link["url"] for link in downloads]
+    for url in expected.get("downloads", []):
+        if url not in downloads:
+            failures.append(f"download {url}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--verbose", action="store_true", help="print every failed expectation")
+    args = parser.parse_args()
+
+    with open(os.path.join(FIXTURES, "expected.json"), encoding="utf-8") as f:
+        expectations = json.load(f)
+    app = import_app({})
+    pages = dict(load_pages(FIXTURES))
+    missing = sorted(set(expectations) - set(pages))
+    if missing:
+        sys.exit(f"fixtures without a page: {', '.join(missing)}")
+
+    print(f"{'page':<26} {'checks':>6} {'cascade':>8} {'blocks':>7}")
+    regressions = 0
+    totals = [0, 0, 0]
+    for name, expected in sorted(expectations.items()):
+        url = "https://example.com/a/"
+        checks = (1 + len(expected.get("include", [])) + len(expected.get("exclude", []))
+                  + len(expected.get("downloads", [])))
+        before = check(cascade_extract(pages[name], url), expected)
+        after = check(app.extract_page(pages[name], url), expected)
+        totals[0] += checks
+        totals[1] += checks - len(before)
+        totals[2] += checks - len(after)
+        regressions += bool(after)
+        print(f"{name:<26} {checks:>6} {checks - len(before):>8} {checks - len(after):>7}")
+        if args.verbose:
+            for failure in after:
+                print(f"    blocks: {failure}")
+            for failure in before:
+                print(f"    cascade: {failure}")
+    print(f"{'total':<26} {totals[0]:>6} {totals[1]:>8} {totals[2]:>7}")
+
+    if regressions:
+        print(f"FAIL: {regressions} page(s) below expectations")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
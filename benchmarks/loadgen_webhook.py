@@ -0,0 +1,142 @@
+"""Post synthetic Telegram updates to app.py in webhook mode and report updates/sec.
+
+For each worker count, app.py is started with RUN_MODE=webhook against a
+stand-in Bot API and stub upstreams.  Updates are posted to /webhook and the
+run ends once every message has been answered.
+
+    python benchmarks/loadgen_webhook.py --workers 1 2 4 --updates 400 --web
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from stubs import ROOT, start_stub_server, start_telegram_stub, stub_env, synthetic_update
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def healthy(port):
+    try:
+        urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1)
+        return True
+    except OSError:
+        return False
+
+
+def post(port, update):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/webhook", data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": "loadgen"}
+    )
+    while True:
+        try:
+            urllib.request.urlopen(request, timeout=10)
+            return
+        except urllib.error.HTTPError as e:
+            if e.code != 503:
+                raise
+            time.sleep(0.1)
+
+
+def run(workers, args, upstream_url, telegram, telegram_url):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update(stub_env(upstream_url))
+        env.update({
+            "RUN_MODE": "webhook",
+            "WEBHOOK_WORKERS": str(workers),
+            "WEBHOOK_SECRET": "loadgen",
+            "PORT": str(port),
+            "TELEGRAM_TOKEN": "123456:loadgen",
+            "TELEGRAM_API_URL": telegram_url,
+            "STATE_BACKEND": "sqlite",
+            "STATE_DB_PATH": os.path.join(tmp, "state.db"),
+            "RATE_DB_PATH": os.path.join(tmp, "rate.db"),
+            "STREAM_RESPONSES": "0",
+            # The stub Bot API has no flood limits; keep the outbox from capping throughput
+            "TELEGRAM_SEND_RATE": "100000",
+            "TELEGRAM_CHAT_RATE": "100000",
+            "TELEGRAM_CHAT_BURST": "100000",
+            # Answer every update on its own so sendMessage counts match updates
+            "CHAT_CANCEL_SUPERSEDED": "0",
+            "CHAT_MAX_BATCH": "1",
+        })
+        proc = subprocess.Popen([sys.executable, "app.py"], cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_until(lambda: healthy(port), 30):
+                raise RuntimeError("app.py did not start")
+            time.sleep(2)  # let workers finish initializing
+
+            chats = max(1, args.updates // args.per_chat)
+            updates = []
+            if args.web:
+                updates += [synthetic_update(chat, chat, "/neton") for chat in range(chats)]
+            for i in range(args.updates):
+                chat = i % chats
+                text = f"question {i}"
+                if args.web:
+                    text += f" {upstream_url}/page/{i}"
+                updates.append(synthetic_update(len(updates), chat, text))
+            expected = len(updates)
+
+            telegram.calls.clear()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=32) as pool:
+                list(pool.map(lambda update: post(port, update), updates))
+            done = wait_until(lambda: telegram.calls.get("sendMessage", 0) >= expected, args.timeout)
+            elapsed = time.perf_counter() - started
+            sent = telegram.calls.get("sendMessage", 0)
+            return expected, sent, elapsed, done
+        finally:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=400)
+    parser.add_argument("--per-chat", type=int, default=4, help="messages per synthetic chat")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub upstream latency (s)")
+    parser.add_argument("--web", action="store_true", help="enable web mode and include a page URL")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    upstream, upstream_url = start_stub_server(latency=args.latency, stream_tokens=20, token_delay=0)
+    telegram, telegram_url = start_telegram_stub()
+
+    print(f"{'workers':>8} {'updates':>8} {'answered':>9} {'seconds':>8} {'updates/s':>10}")
+    for workers in args.workers:
+        expected, sent, elapsed, done = run(workers, args, upstream_url, telegram, telegram_url)
+        flag = "" if done else "  (timed out)"
+        print(f"{workers:>8} {expected:>8} {sent:>9} {elapsed:>8.2f} {sent / elapsed:>10.1f}{flag}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Watch /livez and /readyz while the event loop is blocked on purpose.
+
+The health server runs in its own thread as in production, and a probe
+thread polls it every --probe seconds.  Meanwhile the bot's event loop goes
+through four phases:
+
+  idle      nothing but the lag sampler
+  parse     extract_page on a --page-kb synthetic page, back to back, inline
+  blocked   one synchronous --block second call, like a stray blocking client
+  recover   idle again
+
+For each phase the harness prints the share of probes that saw the process
+ready and live, and the worst lag the sampler reported.
+
+    python benchmarks/loop_lag_harness.py --block 5 --stall 3
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from stubs import import_app
+
+
+def probe(url):
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except OSError:
+        return None, b""
+
+
+def synthetic_page(kb):
+    paragraph = "<p>" + "Event loop lag grows with every blocking parse of a large page. " * 4 + "</p>"
+    return "<html><body><article>" + paragraph * (kb * 1024 // len(paragraph)) + "</article></body></html>"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--phase", type=float, default=4, help="seconds of the idle, parse and recover phases")
+    parser.add_argument("--block", type=float, default=5, help="seconds of the blocking call")
+    parser.add_argument("--stall", type=float, default=3, help="LIVE_MAX_STALL for this run")
+    parser.add_argument("--page-kb", type=int, default=2048)
+    parser.add_argument("--probe", type=float, default=0.25)
+    args = parser.parse_args()
+
+    app = import_app({"STATE_BACKEND": "memory"})
+    app.LIVE_MAX_STALL = args.stall
+    server = app.HealthServer(("127.0.0.1", 0), app.HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    await app.loop_monitor.start()
+
+    phase = "idle"
+    samples = []  # (phase, live, ready, readiness problems)
+    stop = threading.Event()
+
+    def run_probes():
+        while not stop.is_set():
+            live, _ = probe(f"{base}/livez")
+            ready, body = probe(f"{base}/readyz")
+            problems = json.loads(body).get("problems", []) if body else []
+            samples.append((phase, live == 200, ready == 200, problems))
+            time.sleep(args.probe)
+
+    prober = threading.Thread(target=run_probes, daemon=True)
+    prober.start()
+
+    page = synthetic_page(args.page_kb)
+    parses = 0
+    await asyncio.sleep(args.phase)
+    phase = "parse"
+    deadline = time.monotonic() + args.phase
+    while time.monotonic() < deadline:
+        app.extract_page(page, "https://example.com/big")
+        parses += 1
+        await asyncio.sleep(0)
+    phase = "blocked"
+    time.sleep(args.block)
+    await asyncio.sleep(0)  # Let the sampler record the overshoot before the phase changes
+    phase = "recover"
+    await asyncio.sleep(args.phase)
+    stop.set()
+    prober.join()
+    app.loop_monitor.stop()
+    server.shutdown()
+
+    print(f"{args.page_kb} KB page parsed {parses}x inline; blocking call {args.block}s; "
+          f"LIVE_MAX_STALL={args.stall}s READY_MAX_LAG={app.READY_MAX_LAG}s")
+    print(f"{'phase':<8} {'probes':>6} {'live':>6} {'ready':>6}  first not-ready reason")
+    for name in ("idle", "parse", "blocked", "recover"):
+        rows = [sample for sample in samples if sample[0] == name]
+        if not rows:
+            continue
+        live = sum(row[1] for row in rows) / len(rows)
+        ready = sum(row[2] for row in rows) / len(rows)
+        reason = next((row[3][0] for row in rows if row[3]), "-")
+        print(f"{name:<8} {len(rows):>6} {live:>6.0%} {ready:>6.0%}  {reason}")
+    print(f"event loop lag: {app.loop_monitor.stats()}, {app.loop_monitor.histogram.count} samples")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
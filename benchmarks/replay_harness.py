@@ -0,0 +1,405 @@
+"""Record/replay end-to-end harness for the full message pipeline.
+
+record: sends a list of messages through app.handle_message with every
+upstream routed through a local recording proxy.  The proxy forwards each
+request to the real service (or to the local stubs with --upstream stubs)
+and saves the answer into a session file: Together completions, DuckDuckGo
+API and HTML, SearX JSON, telegago JSON and the pages the messages link to.
+The Together API key is read from the environment / .env as usual.
+
+replay: serves a recorded session from a separate process, so the bot's
+peak RSS is measured alone, with latency and error distributions per
+upstream.  Synthetic Telegram updates are driven through handle_message at
+a target rate, and the run reports throughput, per-stage p50/p95/p99, error
+replies and peak RSS.  --json saves the report to compare runs.
+
+Upstream names for --latency / --errors: together, ddg_api, ddg_html, searx,
+telegago, web, plus the groups "search" (all four search endpoints) and
+"default".  Latencies are medians of a lognormal distribution (--jitter is
+its sigma); errors are answered with HTTP 503.
+
+    python benchmarks/replay_harness.py record --messages live_messages.txt --out session.json
+    python benchmarks/replay_harness.py record --upstream stubs \\
+        --messages benchmarks/fixtures/sessions/stub_messages.txt --out benchmarks/fixtures/sessions/stub_session.json
+    python benchmarks/replay_harness.py replay --rate 10 --updates 200 \\
+        --latency together=0.8,search=0.3,web=0.2 --errors searx=0.1 --json run.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import time
+
+import aiohttp
+from aiohttp import web
+
+from stubs import FakeUpdate, import_app, start_stub_server, stub_env
+
+SESSIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "sessions")
+UPSTREAMS = {
+    "together": "TOGETHER_API_URL",
+    "ddg_api": "DDG_API_URL",
+    "ddg_html": "DDG_HTML_URL",
+    "searx": "SEARX_URL",
+    "telegago": "TELEGRAM_SEARCH_API",
+}
+GROUPS = {"ddg_api": "search", "ddg_html": "search", "searx": "search", "telegago": "search"}
+FORWARDED_HEADERS = ("Authorization", "Content-Type", "User-Agent", "Accept")
+KEPT_HEADERS = ("ETag", "Last-Modified", "Retry-After")
+URL_PATTERN = re.compile(r'https?://[^\s<>"]+')
+PLACEHOLDER = re.compile(r"\{web:(\d+)\}")
+
+
+def parse_mapping(text):
+    """`name=value,name=value` into a dict of floats"""
+    mapping = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            mapping[name.strip()] = float(value)
+    return mapping
+
+
+def encode_entry(key, status, headers, body):
+    entry = {"key": key, "status": status, "content_type": headers.get("Content-Type", "application/octet-stream"),
+             "headers": {name: headers[name] for name in KEPT_HEADERS if name in headers}}
+    try:
+        entry["body"] = body.decode("utf-8")
+    except UnicodeDecodeError:
+        entry["body_b64"] = base64.b64encode(body).decode("ascii")
+    return entry
+
+
+def entry_body(entry):
+    if "body_b64" in entry:
+        return base64.b64decode(entry["body_b64"])
+    return entry["body"].encode("utf-8")
+
+
+# --- Recording ---
+class Recorder:
+    """Forward upstream requests to their real targets and keep every answer"""
+
+    def __init__(self, targets):
+        self.targets = targets  # upstream name -> real URL
+        self.web_urls = []  # placeholder index -> real page URL
+        self.responses = {name: [] for name in [*UPSTREAMS, "web"]}
+        self.session = None
+
+    async def handle(self, request):
+        name = request.match_info.get("name", "web")
+        if name == "web":
+            index = int(request.match_info["index"])
+            url, key, params = self.web_urls[index], str(index), None
+        else:
+            url, key, params = self.targets[name], request.query.get("q", ""), request.query
+        headers = {header: request.headers[header] for header in FORWARDED_HEADERS if header in request.headers}
+        async with self.session.request(request.method, url, params=params, data=await request.read(),
+                                        headers=headers, timeout=aiohttp.ClientTimeout(total=60)) as upstream:
+            body = await upstream.read()
+            self.responses[name].append(encode_entry(key, upstream.status, upstream.headers, body))
+            print(f"  recorded {name} {upstream.status} {len(body)} bytes")
+            return web.Response(body=body, status=upstream.status,
+                                headers={"Content-Type": upstream.headers.get("Content-Type", "text/plain")})
+
+
+async def start_site(handler):
+    """Serve `handler` for /<name> and /web/<index> on a free local port"""
+    server = web.Application()
+    server.router.add_route("*", "/web/{index}", handler)
+    server.router.add_route("*", "/{name}", handler)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def record(args):
+    messages = [line.strip() for line in open(args.messages, encoding="utf-8") if line.strip()]
+    stub_base = None
+    if args.upstream == "stubs":
+        stub_server, stub_base = start_stub_server(latency=0, stream_tokens=30, token_delay=0)
+        app = import_app({**stub_env(stub_base), "TOGETHER_API_KEY": "stub"})
+    else:
+        app = import_app({"STATE_BACKEND": "memory"})
+    recorder = Recorder({name: getattr(app, setting) for name, setting in UPSTREAMS.items()})
+    recorder.session = aiohttp.ClientSession()
+    runner, base_url = await start_site(recorder.handle)
+    for name, setting in UPSTREAMS.items():
+        setattr(app, setting, f"{base_url}/{name}")
+
+    def route_through_recorder(match):
+        recorder.web_urls.append(match.group())
+        return f"{base_url}/web/{len(recorder.web_urls) - 1}"
+    routed_url = re.compile(re.escape(base_url) + r"/web/(\d+)")
+
+    recorded_messages = []
+    try:
+        for index, text in enumerate(messages):
+            if stub_base:
+                text = text.replace("{stub}", stub_base)
+            routed = URL_PATTERN.sub(route_through_recorder, text)
+            # Store the message with placeholders so replay can point them anywhere
+            recorded_messages.append(routed_url.sub(r"{web:\1}", routed))
+
+            user_id = 1 + index
+            (await app.state_store.get(user_id))["net"] = not args.no_web
+            print(f"message {index + 1}/{len(messages)}: {text[:70]}")
+            update = FakeUpdate(user_id, routed)
+            await app.handle_message(update, None)
+            await app.chat_scheduler.drain()
+    finally:
+        await recorder.session.close()
+        await runner.cleanup()
+        await app.shutdown()
+        if stub_base:
+            stub_server.shutdown()
+
+    session = {
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "upstream": args.upstream,
+        "messages": recorded_messages,
+        "web_urls": [url.replace(stub_base, "{stub}") if stub_base else url for url in recorder.web_urls],
+        "responses": recorder.responses,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(session, f, ensure_ascii=False, indent=1)
+    counts = ", ".join(f"{name}={len(entries)}" for name, entries in recorder.responses.items())
+    print(f"saved {len(recorded_messages)} messages to {args.out} ({counts})")
+
+
+# --- Replay ---
+class ReplayServer:
+    """Answer upstream requests from a recorded session with injected latency and errors"""
+
+    def __init__(self, session, latency, errors, jitter, token_delay, seed):
+        self.latency = latency
+        self.errors = errors
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.random = random.Random(seed)
+        self.by_key = {}  # (name, key) -> entries
+        self.by_name = {}  # name -> entries
+        self.turns = {}  # round-robin positions
+        self.stats = {}
+        for name, entries in session["responses"].items():
+            self.by_name[name] = entries
+            for entry in entries:
+                self.by_key.setdefault((name, entry["key"]), []).append(entry)
+
+    def setting(self, table, name):
+        for candidate in (name, GROUPS.get(name), "default"):
+            if candidate in table:
+                return table[candidate]
+        return 0.0
+
+    def pick(self, name, key):
+        """The recorded answer for this request, cycling through repeats"""
+        entries = self.by_key.get((name, key)) or self.by_name.get(name)
+        if not entries:
+            return None
+        turn = self.turns.get((name, key), 0)
+        self.turns[(name, key)] = turn + 1
+        return entries[turn % len(entries)]
+
+    async def handle(self, request):
+        name = request.match_info.get("name", "web")
+        if name == "_stats":
+            return web.json_response(self.stats)
+        key = request.match_info["index"] if name == "web" else request.query.get("q", "")
+        await request.read()
+        stats = self.stats.setdefault("web" if name == "web" else name, {"requests": 0, "faults": 0})
+        stats["requests"] += 1
+
+        median = self.setting(self.latency, name)
+        if median > 0:
+            await asyncio.sleep(median * math.exp(self.random.gauss(0, self.jitter)))
+        if self.random.random() < self.setting(self.errors, name):
+            stats["faults"] += 1
+            return web.Response(status=503, text="injected fault")
+
+        entry = self.pick(name, key)
+        if entry is None:
+            return web.Response(status=404, text=f"nothing recorded for {name}")
+        headers = dict(entry["headers"])
+        if name == "web" and headers.get("ETag") and request.headers.get("If-None-Match") == headers["ETag"]:
+            return web.Response(status=304, headers=headers)
+        body = entry_body(entry)
+        headers["Content-Type"] = entry["content_type"]
+        if entry["content_type"].startswith("text/event-stream") and self.token_delay:
+            # Replay the stream event by event at the configured token pace
+            response = web.StreamResponse(status=entry["status"], headers=headers)
+            await response.prepare(request)
+            try:
+                for event in body.split(b"\n\n"):
+                    if event:
+                        await response.write(event + b"\n\n")
+                        await asyncio.sleep(self.token_delay)
+                await response.write_eof()
+            except ConnectionResetError:
+                pass  # The client stops reading at [DONE]
+            return response
+        return web.Response(body=body, status=entry["status"], headers=headers)
+
+
+def serve_replay(session_path, latency, errors, jitter, token_delay, seed, ready):
+    """Replay server process entry point; reports its base URL on `ready`"""
+    async def serve():
+        with open(session_path, encoding="utf-8") as f:
+            session = json.load(f)
+        server = ReplayServer(session, latency, errors, jitter, token_delay, seed)
+        runner, base_url = await start_site(server.handle)
+        ready.put(base_url)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def replay_env(base_url):
+    env = stub_env(base_url)
+    env.update({name_setting: f"{base_url}/{name}" for name, name_setting in UPSTREAMS.items()})
+    env["TOGETHER_API_KEY"] = "replay"
+    return env
+
+
+async def replay(args):
+    with open(args.session, encoding="utf-8") as f:
+        messages = json.load(f)["messages"]
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    server = context.Process(target=serve_replay, daemon=True,
+                             args=(args.session, parse_mapping(args.latency), parse_mapping(args.errors),
+                                   args.jitter, args.token_delay, args.seed, ready))
+    server.start()
+    base_url = ready.get(timeout=30)
+
+    env = replay_env(base_url)
+    env.update(item.split("=", 1) for item in args.env)
+    app = import_app(env)
+    rss_after_import = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # Keep every raw duration so percentiles are exact rather than bucket bounds
+    samples = {}
+    span_exit = app.Span.__exit__
+
+    def recording_exit(span, *exc_info):
+        samples.setdefault(span.name, []).append(time.perf_counter() - span.started)
+        return span_exit(span, *exc_info)
+    app.Span.__exit__ = recording_exit
+    observe_request = app.request_seconds.observe
+
+    def recording_observe(value):
+        samples.setdefault("request", []).append(value)
+        observe_request(value)
+    app.request_seconds.observe = recording_observe
+
+    for user in range(args.users):
+        (await app.state_store.get(1 + user))["net"] = not args.no_web
+
+    rng = random.Random(args.seed)
+    updates = []
+    started = time.perf_counter()
+    due = 0.0
+    try:
+        for index in range(args.updates):
+            delay = started + due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            due += rng.expovariate(args.rate) if args.poisson else 1 / args.rate
+            text = PLACEHOLDER.sub(lambda match: f"{base_url}/web/{match.group(1)}", messages[index % len(messages)])
+            update = FakeUpdate(1 + index % args.users, text)
+            updates.append(update)
+            await app.handle_message(update, None)
+        offered_seconds = time.perf_counter() - started
+        await app.chat_scheduler.drain()
+        elapsed = time.perf_counter() - started
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{base_url}/_stats") as response:
+                upstream_stats = await response.json()
+    finally:
+        await app.shutdown()
+        server.terminate()
+
+    answered = len(samples.get("request", []))
+    errors = sum(1 for update in updates
+                 if any(reply.startswith("⚠️") for reply in update.message.replies))
+    stages = {name: {"count": len(values),
+                     **{f"p{int(q * 100)}": percentile(sorted(values), q) for q in (0.5, 0.95, 0.99)}}
+              for name, values in sorted(samples.items())}
+    report = {
+        "session": args.session,
+        "updates": args.updates,
+        "target_rate": args.rate,
+        "offered_rate": args.updates / offered_seconds,
+        "answered": answered,
+        "error_replies": errors,
+        "elapsed": elapsed,
+        "throughput": answered / elapsed,
+        "stages": stages,
+        "rss_after_import_mb": rss_after_import,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "upstreams": upstream_stats,
+        "env": dict(item.split("=", 1) for item in args.env),
+    }
+
+    print(f"{args.updates} updates at {args.rate:g}/s target ({report['offered_rate']:.2f}/s offered), "
+          f"{args.users} users, {len(messages)} recorded messages")
+    print(f"answered {answered} in {elapsed:.2f}s: {report['throughput']:.2f} msg/s, {errors} error replies")
+    print(f"{'stage':<32} {'count':>6} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+    for name, stage in stages.items():
+        print(f"{name:<32} {stage['count']:>6} {stage['p50']:>8.3f} {stage['p95']:>8.3f} {stage['p99']:>8.3f}")
+    print(f"peak RSS {report['peak_rss_mb']:.1f} MB (after import {rss_after_import:.1f} MB)")
+    print("upstream requests: " + ", ".join(f"{name}={stats['requests']} ({stats['faults']} faults)"
+                                            for name, stats in sorted(upstream_stats.items())))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rec = commands.add_parser("record", help="record upstream answers for a list of messages")
+    rec.add_argument("--messages", required=True, help="text file, one message per line")
+    rec.add_argument("--out", required=True, help="session file to write")
+    rec.add_argument("--upstream", choices=["live", "stubs"], default="live",
+                     help="real services, or the local stubs ({stub} in messages is their base URL)")
+    rec.add_argument("--no-web", action="store_true", help="record with web search off")
+
+    rep = commands.add_parser("replay", help="replay a session at a target update rate")
+    rep.add_argument("--session", default=os.path.join(SESSIONS, "stub_session.json"))
+    rep.add_argument("--rate", type=float, default=5, help="updates per second")
+    rep.add_argument("--updates", type=int, default=100)
+    rep.add_argument("--users", type=int, default=50, help="distinct chats the updates come from")
+    rep.add_argument("--poisson", action="store_true", help="exponential gaps instead of a fixed interval")
+    rep.add_argument("--latency", default="together=0.8,search=0.3,web=0.2", help="median seconds per upstream")
+    rep.add_argument("--jitter", type=float, default=0.3, help="lognormal sigma of upstream latency")
+    rep.add_argument("--errors", default="", help="share of requests answered with 503 per upstream")
+    rep.add_argument("--token-delay", type=float, default=0.01, help="seconds between replayed stream events")
+    rep.add_argument("--seed", type=int, default=1)
+    rep.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="app setting for this run")
+    rep.add_argument("--no-web", action="store_true", help="replay with web search off")
+    rep.add_argument("--json", help="write the report here")
+
+    args = parser.parse_args()
+    asyncio.run(record(args) if args.command == "record" else replay(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""Local stand-ins for every upstream the bot talks to.
+
+The stub server answers the Together chat completions endpoint, the
+DuckDuckGo API and HTML pages, SearX, telegago and arbitrary web pages with
+canned payloads after a configurable delay.  `stub_env()` returns the
+environment overrides that point app.py at it; set them before importing app.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE_PAGES = os.path.join(ROOT, "benchmarks", "fixtures", "pages")
+
+DDG_API_BODY = {
+    "Heading": "Stub Heading",
+    "AbstractText": "Stub abstract text for the query.",
+    "AbstractURL": "https://example.com/abstract"
+}
+
+DDG_HTML_BODY = "".join(
+    '<div class="result__body">'
+    f'<h2 class="result__title"><a href="/l/?uddg=https%3A%2F%2Fexample.com%2Fddg{i}">DDG result {i}</a></h2>'
+    f'<a class="result__snippet">Snippet {i} from the DuckDuckGo HTML page.</a>'
+    '</div>'
+    for i in range(5)
+)
+
+SEARX_BODY = {
+    "results": [
+        {"title": f"SearX result {i}", "url": f"https://example.com/searx{i}",
+         "content": f"SearX content {i}"}
+        for i in range(5)
+    ]
+}
+
+TELEGAGO_BODY = {
+    "results": [
+        {"title": f"Channel {i}", "url": f"@channel{i}", "description": f"Channel {i}",
+         "type": "channel"}
+        for i in range(5)
+    ]
+}
+
+PAGE_BODY = (
+    "<html><head><title>Stub Page</title></head><body><nav>menu</nav>"
+    "<article>" + "<p>Stub article paragraph with some words.</p>" * 50 + "</article>"
+    '<a href="/files/tool.zip">Tool</a></body></html>'
+)
+
+PAGE_ETAG = '"stub-page-v1"'
+
+
+def completion_body(content="Stub completion."):
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serve canned upstream responses after `server.latency` seconds
+
+    Completions additionally wait `server.prefill_per_token` seconds per
+    prompt token, and /fixtures/<name> serves the saved fixture pages.
+    """
+
+    prefill = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type, headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        self.server.hits += 1
+        time.sleep(self.server.latency)
+        path = urlparse(self.path).path
+        if path == "/v1/chat/completions":
+            # A blocking completion arrives only once every token is generated
+            time.sleep(self.prefill + self.server.stream_tokens * self.server.token_delay)
+            text = "".join(f"token{i} " for i in range(self.server.stream_tokens))
+            return 200, completion_body(text), "application/json"
+        if path == "/ddg/api":
+            return 200, DDG_API_BODY, "application/json"
+        if path == "/ddg/html":
+            return 200, DDG_HTML_BODY, "text/html; charset=utf-8"
+        if path == "/searx":
+            return 200, SEARX_BODY, "application/json"
+        if path == "/telegago":
+            return 200, TELEGAGO_BODY, "application/json"
+        if path.startswith("/fixtures/"):
+            with open(os.path.join(FIXTURE_PAGES, os.path.basename(path)), "rb") as f:
+                return 200, f.read(), "text/html; charset=utf-8"
+        if path.startswith("/page"):
+            if self.headers.get("If-None-Match") == PAGE_ETAG:
+                return 304, b"", "text/html; charset=utf-8"
+            # Distinct bodies per path so content-addressed caching can't skip the parse
+            body = PAGE_BODY.replace("Stub Page", f"Stub Page {path}")
+            return 200, body, "text/html; charset=utf-8", {"ETag": PAGE_ETAG}
+        return 404, "not found", "text/plain"
+
+    def do_GET(self):
+        self._send(*self._route())
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        # Prompt processing time grows with the prompt, about 4 characters per token
+        prompt_chars = sum(len(message.get("content", "")) for message in payload.get("messages", []))
+        self.prefill = prompt_chars / 4 * self.server.prefill_per_token
+        if payload.get("stream") and urlparse(self.path).path == "/v1/chat/completions":
+            self._stream_completion()
+        else:
+            self._send(*self._route())
+
+    def _stream_completion(self):
+        """Answer with an SSE token stream: first token after `latency`, then one per `token_delay`"""
+        self.server.hits += 1
+        time.sleep(self.server.latency + self.prefill)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i in range(self.server.stream_tokens):
+            chunk = {"choices": [{"delta": {"content": f"token{i} "}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.server.token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class FaultyStubHandler(StubHandler):
+    """StubHandler that injects the faults configured in `server.faults`
+
+    `server.faults` maps a path to {"error_rate": share of requests answered
+    with `status`, "status": HTTP status, "delay": extra seconds per request}.
+    The dict may be swapped while the server runs.
+    """
+
+    def _route(self):
+        fault = self.server.faults.get(urlparse(self.path).path)
+        if fault:
+            time.sleep(fault.get("delay", 0))
+            if random.random() < fault.get("error_rate", 0):
+                self.server.hits += 1
+                self.server.faulted += 1
+                return fault.get("status", 503), "injected fault", "text/plain"
+        return super()._route()
+
+    def do_POST(self):
+        # Faults apply to completions too, so never take the streaming path
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self._send(*self._route())
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return  # The client cancelled its request
+        super().handle_error(request, client_address)
+
+
+class TelegramStubHandler(StubHandler):
+    """Minimal Bot API: every method succeeds and sent messages are counted"""
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.calls[method] = self.server.calls.get(method, 0) + 1
+            message_id = sum(self.server.calls.values())
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": 1, "type": "private"}, "text": "stub"}
+        else:
+            result = True
+        self._send(200, {"ok": True, "result": result}, "application/json")
+
+
+def start_telegram_stub():
+    """Start a stand-in Telegram Bot API and return (server, base_url)"""
+    server = StubServer(("127.0.0.1", 0), TelegramStubHandler)
+    server.calls = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def synthetic_update(update_id, chat_id, text):
+    """A Telegram private-chat text message update as the Bot API would post it"""
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Load"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+def start_stub_server(latency=0.2, handler=StubHandler, stream_tokens=50, token_delay=0.02, prefill_per_token=0.0):
+    """Start the stub server on a free port and return (server, base_url)"""
+    server = StubServer(("127.0.0.1", 0), handler)
+    server.latency = latency
+    server.prefill_per_token = prefill_per_token
+    server.stream_tokens = stream_tokens
+    server.token_delay = token_delay
+    server.hits = 0
+    server.faults = {}
+    server.faulted = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def stub_env(base_url):
+    """Environment overrides that route every upstream to the stub server"""
+    return {
+        "TOGETHER_API_URL": f"{base_url}/v1/chat/completions",
+        "DDG_API_URL": f"{base_url}/ddg/api",
+        "DDG_HTML_URL": f"{base_url}/ddg/html",
+        "SEARX_URL": f"{base_url}/searx",
+        "TELEGRAM_SEARCH_API": f"{base_url}/telegago",
+        "STATE_BACKEND": "memory",
+        "RATE_LIMITS": "together=100000,duckduckgo=100000,searx=100000,telegram=100000",
+    }
+
+
+def import_app(env):
+    """Import app.py from the repository root with `env` applied"""
+    os.environ.update(env)
+    os.chdir(ROOT)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+# --- Fake Telegram objects ---
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeMessage:
+    """Collects replies instead of sending them to Telegram"""
+
+    def __init__(self, text, chat_id):
+        self.text = text
+        self.chat = FakeChat(chat_id)
+        self.chat_id = chat_id
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def reply_chat_action(self, action, **kwargs):
+        return True
+
+    async def edit_text(self, text, **kwargs):
+        if self.replies:
+            self.replies[-1] = text
+        return self
+
+
+class FakeUpdate:
+    def __init__(self, user_id, text):
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeChat(user_id)
+        self.message = FakeMessage(text, user_id)